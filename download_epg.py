@@ -8,18 +8,71 @@ Usage:
   python download_epg.py
   python download_epg.py --output epg_all.xml.gz
   python download_epg.py --output epg_all.xml.gz --overwrite
+  python download_epg.py --overwrite --cache-dir .epg_cache
 """
 from __future__ import annotations
 
 import argparse
 import gzip
+import hashlib
+import itertools
+import json
 import os
+import re
+import shutil
 import sys
 import urllib.request
 import urllib.error
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from typing import List, Optional, Set
+from pathlib import Path
+from types import ModuleType
+from typing import IO, Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Type, cast
 import xml.etree.ElementTree as ET
+from xml.sax.saxutils import quoteattr, unescape
+
+# Errors a corrupt or truncated gzip stream can raise while being read
+GZIP_ERRORS: Tuple[Type[BaseException], ...] = (OSError, EOFError, zlib.error)
+
+_igzip: ModuleType
+try:
+    # ISA-L inflate/deflate is several times faster than stdlib zlib; optional.
+    # Bound under another name so the stdlib fallback below is not a
+    # redefinition; the ignores cover type-checking without isal installed.
+    from isal import igzip as isal_igzip  # type: ignore[import-not-found, unused-ignore]
+    from isal import isal_zlib  # type: ignore[import-not-found, unused-ignore]
+    _igzip = isal_igzip
+    # IsalError is a plain Exception subclass, not an OSError (the isal stubs
+    # declare it as an instance, hence the cast)
+    GZIP_ERRORS += (cast(Type[BaseException], isal_zlib.error),)
+except ImportError:
+    _igzip = gzip
+
+try:
+    # Optional: a pooled client reuses TLS connections to the feed host.
+    import urllib3
+    HAVE_URLLIB3 = True
+except ImportError:
+    HAVE_URLLIB3 = False
+
+# A whole top-level <channel>/<programme> element, self-closing or not, or a
+# comment/CDATA section that must be skipped over as a unit. Start tags are
+# scanned quote-aware, since ">" is legal inside attribute values.
+START_TAG_BODY = rb"""(?:[^>"']|"[^"]*"|'[^']*')*+"""
+ELEMENT_RE = re.compile(
+    rb"<!--.*?-->|<!\[CDATA\[.*?\]\]>|<(channel|programme)(?=[\s/>])" + START_TAG_BODY + rb"(?:(?<=/)>|>.*?</\1\s*>)",
+    re.DOTALL,
+)
+ELEMENT_START_RE = re.compile(rb"<(?:!--|!\[CDATA\[|(?:channel|programme)(?=[\s/>]))")
+# Walks the <channel> start tag attribute by attribute up to id="...", so an
+# "id=" inside another attribute's value is never picked up
+CHANNEL_ID_RE = re.compile(
+    rb"""<channel(?:\s+(?!id\s*=)[^\s=/>]+\s*=\s*(?:"[^"]*"|'[^']*'))*\s+id\s*=\s*(["'])(.*?)\1""",
+    re.DOTALL,
+)
+# unescape() only knows &amp; &lt; &gt; by default
+XML_ATTR_ENTITIES = {"&quot;": '"', "&apos;": "'"}
 
 EPG_URLS = [
     "https://epgshare01.online/epgshare01/epg_ripper_MN1.xml.gz",
@@ -33,97 +86,253 @@ EPG_URLS = [
     "https://epgshare01.online/epgshare01/epg_ripper_NL1.xml.gz",
 ]
 
+# All feeds live on one host; size the pool for one connection per download worker
+HTTP_POOL: Optional[urllib3.PoolManager] = (
+    urllib3.PoolManager(maxsize=len(EPG_URLS), retries=urllib3.Retry(total=2, backoff_factor=0.3)) if HAVE_URLLIB3 else None
+)
 
-def download_bytes(url: str, timeout: int = 30) -> Optional[bytes]:
+
+def cache_paths(cache_dir: str, url: str) -> Tuple[str, str]:
+    # Cached body and its validator sidecar, keyed by URL
+    key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+    base = os.path.join(cache_dir, key)
+    return base + ".xml.gz", base + ".json"
+
+
+def load_cached(cache_dir: str, url: str) -> Tuple[Optional[bytes], Dict[str, Any]]:
+    body_path, meta_path = cache_paths(cache_dir, url)
     try:
-        print(f"Downloading: {url}")
-        with urllib.request.urlopen(url, timeout=timeout) as resp:
-            if getattr(resp, "status", 200) >= 400:
-                print(f"HTTP error: {getattr(resp, 'status', '')} {getattr(resp, 'reason', '')}")
-                return None
-            buf = BytesIO()
-            chunk_size = 16 * 1024
-            while True:
-                chunk = resp.read(chunk_size)
-                if not chunk:
-                    break
-                buf.write(chunk)
-            return buf.getvalue()
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        with open(body_path, "rb") as f:
+            return f.read(), meta
+    except (OSError, ValueError):
+        return None, {}
+
+
+def discard_cached(paths: Iterable[str]) -> None:
+    for path in paths:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def store_cached(cache_dir: str, url: str, data: bytes, etag: Optional[str], last_modified: Optional[str]) -> None:
+    body_path, meta_path = cache_paths(cache_dir, url)
+    xml_path = body_path[: -len(".gz")]
+    # A new body always invalidates the inflated copy of the old one
+    discard_cached((xml_path,))
+    if not etag and not last_modified:
+        # Nothing to revalidate with; the previous entry no longer matches
+        # the upstream body, so drop it.
+        discard_cached((meta_path,))
+        return
+    meta = {"url": url, "etag": etag, "last_modified": last_modified}
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to temp files and swap them in so a crash never leaves a
+        # sidecar pointing at a truncated body.
+        with open(body_path + ".tmp", "wb") as f:
+            f.write(data)
+        with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(body_path + ".tmp", body_path)
+        os.replace(meta_path + ".tmp", meta_path)
+    except OSError as e:
+        print(f"Failed to update cache for {url}: {e}")
+
+
+def http_get(url: str, headers: Dict[str, str], timeout: int) -> Tuple[int, str, bytes, Dict[str, str]]:
+    # Returns (status, reason, body, headers) with lower-cased header names;
+    # error statuses are returned, not raised. Uses the shared urllib3 pool
+    # when available.
+    if HTTP_POOL is not None:
+        pooled = HTTP_POOL.request("GET", url, headers=headers, timeout=timeout)
+        return pooled.status, pooled.reason or "", pooled.data, {k.lower(): v for k, v in pooled.headers.items()}
+    try:
+        req = urllib.request.Request(url, headers=headers)
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            # read() sizes its buffer from Content-Length when the server sends it
+            return resp.status, resp.reason, resp.read(), {k.lower(): v for k, v in resp.headers.items()}
     except urllib.error.HTTPError as e:
-        print(f"HTTP error: {e.code} {e.reason}")
-        return None
+        return e.code, e.reason, b"", {k.lower(): v for k, v in e.headers.items()}
+
+
+def download_bytes(url: str, timeout: int = 30, cache_dir: Optional[str] = None) -> Tuple[Optional[bytes], bool]:
+    # With a cache_dir, revalidate the cached copy using a conditional GET;
+    # a 304 answer costs no body transfer at all. The flag tells whether the
+    # cached body was returned.
+    cached, meta = load_cached(cache_dir, url) if cache_dir else (None, {})
+    headers: Dict[str, str] = {}
+    if cached is not None:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+    try:
+        print(f"Downloading: {url}")
+        status, reason, data, resp_headers = http_get(url, headers, timeout)
     except urllib.error.URLError as e:
         print(f"URL error: {e}")
-        return None
+        return None, False
     except Exception as e:
         print(f"Unexpected download error: {e}")
-        return None
-
-
-def extract_gzip(data: bytes) -> Optional[bytes]:
+        return None, False
+
+    if status == 304 and cached is not None:
+        print(f"Not modified, using cached copy: {url}")
+        return cached, True
+    if status >= 300:
+        print(f"HTTP error: {status} {reason}")
+        return None, False
+    if cache_dir:
+        store_cached(cache_dir, url, data, resp_headers.get("etag"), resp_headers.get("last-modified"))
+    return data, False
+
+
+def open_gzip(data: bytes) -> IO[bytes]:
+    # Decompress lazily as the parser reads, instead of materializing the
+    # whole inflated feed next to the compressed one.
+    return _igzip.GzipFile(fileobj=BytesIO(data), mode="rb")
+
+
+class FeedReadError(Exception):
+    # A feed failed to decompress part way; raised from the read side only so
+    # errors writing the output are never mistaken for a bad input.
+    pass
+
+
+def iter_feed_elements(source: IO[bytes], head: bytes = b"", chunk_size: int = 1024 * 1024) -> Iterator[Tuple[bytes, bytes]]:
+    # Yield (tag, raw_bytes) for each top-level <channel>/<programme> element.
+    # Elements are merged verbatim, so slice them out of the decompressed
+    # stream instead of parsing and re-serializing them. Comments and CDATA
+    # are skipped whole so markup inside them is never emitted. Anything cut
+    # off at the end of a chunk is carried over and completed by the next one.
+    # `head` holds bytes already read from the start of `source`.
+    buf = head
+    while True:
+        try:
+            chunk = source.read(chunk_size)
+        except GZIP_ERRORS as e:
+            raise FeedReadError(e) from e
+        buf += chunk
+        pos = 0
+        while True:
+            start = ELEMENT_START_RE.search(buf, pos)
+            if start is None:
+                # Keep a short tail so an opening tag split across chunks still matches
+                pos = max(pos, len(buf) - 16)
+                break
+            elem = ELEMENT_RE.match(buf, start.start())
+            if elem is None:
+                if chunk:
+                    pos = start.start()
+                    break
+                # Unterminated at end of input; skip the opener
+                pos = start.end()
+                continue
+            if elem.group(1):
+                yield elem.group(1), elem.group(0)
+            pos = elem.end()
+        if not chunk:
+            return
+        buf = buf[pos:]
+
+
+def read_root_attribs(head: bytes) -> Dict[str, str]:
+    # Only the root start tag is needed, so parse just the first bytes of a feed.
+    for _event, elem in ET.iterparse(BytesIO(head), events=("start",)):
+        return dict(elem.attrib)
+    return {}
+
+
+def merge_feed(source: IO[bytes], head: bytes, seen: Set[str], out_write: Callable[[bytes], object], dedupe_channels: bool, batch_size: int = 1024) -> None:
+    # Hot loop of the merge, fully typed like the rest of the module; it passes
+    # mypy and builds with mypyc, though it is run as plain Python. Kept
+    # elements are joined and written in batches, so the gzip writer gets one
+    # large deflate call per batch rather than one per element.
+    id_match = CHANNEL_ID_RE.match
+    parts: List[bytes] = []
     try:
-        return gzip.decompress(data)
-    except Exception as e:
-        print(f"Failed to decompress gzip: {e}")
-        return None
-
-
-def unify_xml_bytes_list(xml_bytes_list: List[bytes], output_path: str, overwrite: bool = False, dedupe_channels: bool = False) -> int:
+        for tag, raw in iter_feed_elements(source, head):
+            if tag == b"channel" and dedupe_channels:
+                m = id_match(raw)
+                # Compare unescaped values, as ElementTree did (A&amp;E == A&E)
+                ch_id = unescape(m.group(2).decode("utf-8", "replace"), XML_ATTR_ENTITIES) if m else ""
+                if ch_id:
+                    if ch_id in seen:
+                        continue
+                    seen.add(ch_id)
+            parts.append(raw)
+            if len(parts) >= batch_size:
+                parts.append(b"")
+                out_write(b"\n".join(parts))
+                parts.clear()
+    except FeedReadError:
+        # Keep whatever was read before a decompression error
+        if parts:
+            parts.append(b"")
+            out_write(b"\n".join(parts))
+        raise
+    if parts:
+        parts.append(b"")
+        out_write(b"\n".join(parts))
+
+
+def unify_xml_streams(sources: Iterable[IO[bytes]], output_path: str, overwrite: bool = False, dedupe_channels: bool = False) -> int:
     # Force .gz output
     if not output_path.endswith(".gz"):
         output_path += ".gz"
 
-    gz_path = output_path
-
-    if os.path.exists(gz_path) and not overwrite:
-        print(f"Error: output file '{gz_path}' exists. Use --overwrite to replace.")
-        return 2
+    # Sources may still be downloading; only the first is needed up front
+    sources = iter(sources)
+    first = next(sources, None)
+    if first is None:
+        print("No XML data downloaded successfully.")
+        return 1
+    sources = itertools.chain((first,), sources)
 
-    out_dir = os.path.dirname(os.path.abspath(gz_path))
-    if out_dir and not os.path.exists(out_dir):
-        os.makedirs(out_dir, exist_ok=True)
+    gz_path = output_path
+    Path(gz_path).parent.mkdir(parents=True, exist_ok=True)
 
     written_channel_ids: Set[str] = set()
 
-    # Try to copy root attributes from first XML
+    # Try to copy root attributes from first XML. Its head is handed back to
+    # the merge below rather than rewinding, which gzip readers do poorly.
     root_attribs = {}
+    head = b""
     try:
-        if xml_bytes_list and xml_bytes_list[0]:
-            first_tree = ET.parse(BytesIO(xml_bytes_list[0]))
-            root_attribs = dict(first_tree.getroot().attrib)
+        head = first.read(64 * 1024)
+        root_attribs = read_root_attribs(head)
     except Exception:
         pass
 
     try:
-        with gzip.open(gz_path, "wb") as f_out:
-            f_out.write('<?xml version="1.0" encoding="utf-8"?>\n'.encode("utf-8"))
-            attrs = "".join(f' {k}="{v}"' for k, v in root_attribs.items())
-            f_out.write(f"<tv{attrs}>\n".encode("utf-8"))
-
-            for idx, data in enumerate(xml_bytes_list):
-                if not data:
-                    continue
-                buf = BytesIO(data)
+        # Exclusive create ("x") refuses an existing file without a racy exists() check.
+        # Level 1 is far cheaper to produce and only slightly larger; consumers
+        # decompress the file once.
+        gz_out = _igzip.open(gz_path, "wb" if overwrite else "xb", compresslevel=1)
+    except FileExistsError:
+        print(f"Error: output file '{gz_path}' exists. Use --overwrite to replace.")
+        return 2
+    except OSError as e:
+        print(f"Failed to write gzip '{gz_path}': {e}")
+        return 1
+
+    try:
+        with gz_out as f_out:
+            # Attribute values come from the feed decoded, so they must be re-escaped
+            attrs = "".join(f" {k}={quoteattr(v)}" for k, v in root_attribs.items())
+            f_out.write(f'<?xml version="1.0" encoding="utf-8"?>\n<tv{attrs}>\n'.encode("utf-8"))
+
+            for idx, source in enumerate(sources):
                 try:
-                    tree = ET.parse(buf)
-                    root = tree.getroot()
-
-                    for elem in root.findall("channel"):
-                        ch_id = elem.get("id", "")
-                        if dedupe_channels and ch_id:
-                            if ch_id in written_channel_ids:
-                                continue
-                            written_channel_ids.add(ch_id)
-                        f_out.write(ET.tostring(elem, encoding="utf-8"))
-                        f_out.write(b"\n")
-
-                    for elem in root.findall("programme"):
-                        f_out.write(ET.tostring(elem, encoding="utf-8"))
-                        f_out.write(b"\n")
-
-                except ET.ParseError as e:
-                    print(f"XML parse error in input #{idx}: {e}")
-                    continue
+                    merge_feed(source, head if idx == 0 else b"", written_channel_ids, f_out.write, dedupe_channels)
+                except FeedReadError as e:
+                    print(f"Failed to decompress input #{idx}: {e}")
+                finally:
+                    source.close()
 
             f_out.write(b"</tv>\n")
 
@@ -134,24 +343,69 @@ def unify_xml_bytes_list(xml_bytes_list: List[bytes], output_path: str, overwrit
         return 1
 
 
-def download_and_unify(urls: List[str], output_path: str, timeout: int = 30, overwrite: bool = False, dedupe_channels: bool = False) -> int:
-    xml_bytes_list: List[bytes] = []
-    for url in urls:
-        raw = download_bytes(url, timeout=timeout)
-        if raw is None:
-            print(f"Skipping URL due to download error: {url}")
-            continue
-        extracted = extract_gzip(raw)
-        if extracted is None:
-            print(f"Skipping URL due to decompression error: {url}")
-            continue
-        xml_bytes_list.append(extracted)
-
-    if not xml_bytes_list:
-        print("No XML data downloaded successfully.")
-        return 1
+def open_cached_xml(cache_dir: str, url: str, raw: bytes) -> Optional[IO[bytes]]:
+    # Inflate a feed that came back 304 once and read the XML straight from
+    # disk on later runs. The copy is tied to the SHA-1 of its compressed body
+    # through the sidecar.
+    body_path, meta_path = cache_paths(cache_dir, url)
+    xml_path = body_path[: -len(".gz")]
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    gz_sha1 = hashlib.sha1(raw).hexdigest()
+    try:
+        fresh = meta.get("gz_sha1") == gz_sha1 and meta.get("xml_size") == os.path.getsize(xml_path)
+    except OSError:
+        fresh = False
+
+    try:
+        if not fresh:
+            with open_gzip(raw) as src, open(xml_path + ".tmp", "wb") as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            os.replace(xml_path + ".tmp", xml_path)
+            meta.update(gz_sha1=gz_sha1, xml_size=os.path.getsize(xml_path))
+            with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(meta, f)
+            os.replace(meta_path + ".tmp", meta_path)
+        return open(xml_path, "rb")
+    except GZIP_ERRORS:
+        # Leave it to the streaming path, which reports decompression errors
+        discard_cached((xml_path + ".tmp",))
+        return None
+
+
+def fetch_xml(url: str, timeout: int = 30, cache_dir: Optional[str] = None) -> Optional[IO[bytes]]:
+    raw, from_cache = download_bytes(url, timeout=timeout, cache_dir=cache_dir)
+    if raw is None:
+        print(f"Skipping URL due to download error: {url}")
+        return None
+    # A fresh body is streamed once; only an unchanged feed is worth inflating to disk
+    if cache_dir and from_cache:
+        cached_xml = open_cached_xml(cache_dir, url, raw)
+        if cached_xml is not None:
+            return cached_xml
+    return open_gzip(raw)
+
+
+def fetch_all(urls: List[str], timeout: int = 30, cache_dir: Optional[str] = None) -> Iterator[IO[bytes]]:
+    # Downloads are I/O-bound: fetch all feeds concurrently, but yield them in
+    # submit order so the merge stays deterministic. Each feed is yielded as
+    # soon as it and its predecessors are in, so merging overlaps the rest of
+    # the downloads.
+    with ThreadPoolExecutor(max_workers=max(1, len(urls))) as ex:
+        futures = [ex.submit(fetch_xml, url, timeout, cache_dir) for url in urls]
+        for fut in futures:
+            source = fut.result()
+            if source is not None:
+                yield source
+
 
-    return unify_xml_bytes_list(xml_bytes_list, output_path, overwrite=overwrite, dedupe_channels=dedupe_channels)
+def download_and_unify(urls: List[str], output_path: str, timeout: int = 30, overwrite: bool = False, dedupe_channels: bool = False, cache_dir: Optional[str] = None) -> int:
+    sources = fetch_all(urls, timeout=timeout, cache_dir=cache_dir)
+    return unify_xml_streams(sources, output_path, overwrite=overwrite, dedupe_channels=dedupe_channels)
 
 
 def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
@@ -159,12 +413,13 @@ def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
     p.add_argument("--output", "-o", default="epg_all.xml.gz", help="Output merged gzip XML path")
     p.add_argument("--timeout", type=int, default=30, help="Network timeout in seconds")
     p.add_argument("--overwrite", action="store_true", help="Overwrite output if it exists")
+    p.add_argument("--cache-dir", default=None, help="Keep downloaded feeds here and revalidate them with conditional GETs")
     return p.parse_args(argv)
 
 
 def main(argv: Optional[list[str]] = None) -> int:
     args = parse_args(argv)
-    return download_and_unify(EPG_URLS, args.output, timeout=args.timeout, overwrite=args.overwrite, dedupe_channels=True)
+    return download_and_unify(EPG_URLS, args.output, timeout=args.timeout, overwrite=args.overwrite, dedupe_channels=True, cache_dir=args.cache_dir)
 
 
 if __name__ == "__main__":
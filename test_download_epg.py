@@ -0,0 +1,53 @@
+import unittest
+from io import BytesIO
+
+import download_epg
+
+FEED = (
+    b'<?xml version="1.0" encoding="UTF-8"?>\n<tv generator-info-name="x">\n'
+    b'<channel id="a" x="1>2"/>'
+    b'<programme channel="a">p1</programme>'
+    b'<channel id="b">B</channel>'
+    b"<channel note=\"id='z'\" id='c&amp;d'/>"
+    b'<!-- <channel id="in-comment"/> -->'
+    b'<![CDATA[<programme channel="in-cdata">x</programme>]]>'
+    b'<channel-x id="not-a-channel"/>'
+    b'<programme channel="b" title="a > b">p2</programme>\n'
+    b"</tv>\n"
+)
+
+EXPECTED = [
+    (b"channel", b'<channel id="a" x="1>2"/>'),
+    (b"programme", b'<programme channel="a">p1</programme>'),
+    (b"channel", b'<channel id="b">B</channel>'),
+    (b"channel", b"<channel note=\"id='z'\" id='c&amp;d'/>"),
+    (b"programme", b'<programme channel="b" title="a > b">p2</programme>'),
+]
+
+
+class IterFeedElementsTest(unittest.TestCase):
+    def test_gt_in_attribute_value(self) -> None:
+        got = list(download_epg.iter_feed_elements(BytesIO(FEED)))
+        self.assertEqual(got, EXPECTED)
+
+    def test_every_chunk_boundary(self) -> None:
+        for chunk_size in range(1, len(FEED) + 1):
+            with self.subTest(chunk_size=chunk_size):
+                got = list(download_epg.iter_feed_elements(BytesIO(FEED), chunk_size=chunk_size))
+                self.assertEqual(got, EXPECTED)
+
+
+class MergeFeedTest(unittest.TestCase):
+    def test_channel_ids_deduped_across_feeds(self) -> None:
+        out: list = []
+        seen: set = set()
+        for _ in range(2):
+            download_epg.merge_feed(BytesIO(FEED), b"", seen, out.append, True)
+        merged = b"".join(out)
+        self.assertEqual(seen, {"a", "b", "c&d"})
+        self.assertEqual(merged.count(b"<channel "), 3)
+        self.assertEqual(merged.count(b"<programme "), 4)
+
+
+if __name__ == "__main__":
+    unittest.main()